@@ -7,25 +7,39 @@ MIT License
 Copyright (c) 2018-2020 Jongwook Choi (@wookayin)
 """
 
-from typing import List, Tuple, Optional
+from typing import Callable, List, Tuple, Optional
+import functools
+import gzip
+import html
 import os
+import random
+import re
+import shlex
+import time
 import traceback
 import urllib
 
 import asyncio
 import asyncssh
 
-from datetime import datetime
-from collections import OrderedDict, Counter
+from collections import Counter
 
 from termcolor import cprint, colored
-import jinja2
 import ansi2html
 
+import fast_ansi2html
+
 
 __PATH__ = os.path.abspath(os.path.dirname(__file__))
 
 DEFAULT_GPUSTAT_COMMAND = "gpustat --color --gpuname-width 25"
+OUTPUT_PATH = "../public_html/cluster_status.html"
+
+# maximum number of SSH handshakes in progress at the same time
+MAX_CONCURRENT_CONNECTS = 32
+
+# terminates the output of each query on the persistent remote process
+END_MARKER = "---END---"
 
 
 # monkey-patch ansi2html scheme. TODO: better color codes
@@ -33,16 +47,89 @@ scheme = 'solarized'
 ansi2html.style.SCHEME[scheme] = list(ansi2html.style.SCHEME[scheme])
 ansi2html.style.SCHEME[scheme][0] = '#555555'
 ansi_conv = ansi2html.Ansi2HTMLConverter(dark_bg=True, scheme=scheme)
+ANSI_HEADERS = ansi_conv.produce_headers().replace('\n', ' ')
+
+
+TEMPLATE_VAR_RE = re.compile(r'{{\s*(\w+)\s*(\|\s*safe\s*)?}}')
+
+
+def compile_template(path: str, **constants) -> Callable[..., str]:
+    '''Compile a template with jinja-style `{{ var }}` (or `{{ var | safe }}`)
+    placeholders into a render function. Variables given in `constants` are
+    substituted once here, the others are passed to the render function.'''
+    with open(path) as f:
+        source = f.read()
+
+    parts, names = [], []   # literal text, and (name, safe, index in parts)
+    last_end = 0
+    for match in TEMPLATE_VAR_RE.finditer(source):
+        parts.append(source[last_end:match.start()])
+        name, safe = match.groups()
+        if name in constants:
+            value = str(constants[name])
+            parts.append(value if safe else html.escape(value))
+        else:
+            names.append((name, bool(safe), len(parts)))
+            parts.append('')
+        last_end = match.end()
+    parts.append(source[last_end:])
+
+    def render(**kwargs) -> str:
+        out = list(parts)
+        for name, safe, i in names:
+            value = str(kwargs[name])
+            out[i] = value if safe else html.escape(value)
+        return ''.join(out)
+
+    return render
+
+
+# the template is immutable, so compile it only once.
+render_template = compile_template(
+    os.path.join(__PATH__, 'template', 'cluster_status.html'),
+    ansi2html_headers=ANSI_HEADERS)
+
+
+@functools.lru_cache(maxsize=4096)
+def convert_line(line: str) -> str:
+    '''Convert a single line of ANSI output into html. Most lines of gpustat
+    (hostnames, GPU names, idle GPUs) repeat across polls, hence the cache.'''
+    return fast_ansi2html.convert(line)
+
+
+def convert_status(status: str) -> str:
+    '''Convert a (multi-line) host status into html, line by line.'''
+    return '\n'.join(convert_line(line) for line in status.split('\n'))
 
 
 class Context(object):
     '''The global context object.'''
     def __init__(self):
-        self.host_status = OrderedDict()
+        # per-host states, indexed by the host index given by add_host()
+        self.host_status: List[str] = []
+        self.host_html: List[str] = []
+        self.host_prefix: List[str] = []
+        self.last_rendered_hash = None
+        self.dirty_event = None  # asyncio.Event, created in spawn_clients()
         self.interval = 5.0
 
-    def host_set_message(self, hostname: str, msg: str):
-        self.host_status[hostname] = colored(f"({hostname}) ", 'white') + msg + '\n'
+    def add_host(self, hostname: str) -> int:
+        '''Register a host, and return its index.'''
+        self.host_status.append('')
+        self.host_html.append('')
+        self.host_prefix.append(colored(f"({hostname}) ", 'white'))
+        return len(self.host_status) - 1
+
+    def host_set_status(self, index: int, status: str):
+        '''Update the status of a host, converting it into html only if changed.'''
+        if self.host_status[index] != status:
+            self.host_status[index] = status
+            self.host_html[index] = convert_status(status)
+            if self.dirty_event is not None:
+                self.dirty_event.set()
+
+    def host_set_message(self, index: int, msg: str):
+        self.host_set_status(index, self.host_prefix[index] + msg + '\n')
 
 
 context = Context()
@@ -59,20 +146,25 @@ async def spawn_clients(hosts: List[str], exec_cmd: str, *,
         assert pr.hostname is not None, netloc
         return (pr.hostname, pr.port)
 
+    context.dirty_event = asyncio.Event()
+
     try:
         host_names, host_ports = zip(*(_parse_host_string(host) for host in hosts))
 
         # initial response
-        for hostname in host_names:
-            context.host_set_message(hostname, "Loading ...")
+        host_indices = [context.add_host(hostname) for hostname in host_names]
+        for index in host_indices:
+            context.host_set_message(index, "Loading ...")
 
         name_length = max(len(hostname) for hostname in host_names)
-
-        # launch all clients parallel
-        await asyncio.gather(*[
-            run_client(hostname, exec_cmd, port=port or default_port,
-                    verbose=verbose, name_length=name_length)
-            for (hostname, port) in zip(host_names, host_ports)
+        connect_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+
+        # launch all clients parallel, and a single renderer
+        await asyncio.gather(run_renderer(), *[
+            run_client(hostname, exec_cmd, index=index, port=port or default_port,
+                    verbose=verbose, name_length=name_length,
+                    connect_semaphore=connect_semaphore)
+            for (index, hostname, port) in zip(host_indices, host_names, host_ports)
         ])
     except Exception as ex:
         # TODO: throw the exception outside and let aiohttp abort startup
@@ -85,59 +177,119 @@ async def spawn_clients(hosts: List[str], exec_cmd: str, *,
 def render_webpage():
     '''Renders the html page.'''
 
-    body = ''
-    for host, status in context.host_status.items():
-        if not status:
-            continue
-        body += status
-    body = ansi_conv.convert(body, full=False)
+    body = ''.join(context.host_html)
+    h = hash(body)
+    if h == context.last_rendered_hash:
+        return  # nothing has changed since the last render
 
-    with open("template/cluster_status.html") as f:
-        template = jinja2.Template(f.read())
+    data = render_template(gpustat_content=body).encode('utf-8')
+    write_atomic(OUTPUT_PATH, data)
+    # precompressed copy, for webservers configured to serve it (gzip_static)
+    write_atomic(OUTPUT_PATH + '.gz', gzip.compress(data, compresslevel=6))
+    context.last_rendered_hash = h
 
-    contents = template.render(
-        ansi2html_headers=ansi_conv.produce_headers().replace('\n', ' '),
-        gpustat_content=body)
-    
-    with open("../public_html/cluster_status.html", "w") as f:
-        f.write(contents)
 
+async def run_renderer(debounce=0.2):
+    '''A single writer of the html page, re-rendering it whenever any host
+    has updated its status. Updates arriving together are coalesced.'''
+    loop = asyncio.get_running_loop()
+    while True:
+        await context.dirty_event.wait()
+        await asyncio.sleep(debounce)
+        context.dirty_event.clear()
+        # render and write in a thread, not to stall the SSH clients
+        try:
+            await loop.run_in_executor(None, render_webpage)
+        except Exception as e:
+            # e.g. the output directory is missing or the disk is full;
+            # keep monitoring, and retry upon the next update.
+            cprint(f"Failed to render the page: {type(e).__name__}: {e}", color='red')
+
+
+def write_atomic(path: str, contents: bytes):
+    '''Write a file via a temporary file and rename, so that the webserver
+    never serves a partially written page.'''
+    data = memoryview(contents)
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:  # a single write(2), unless interrupted
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
 
-async def run_client(hostname: str, exec_cmd: str, *, port=22,
-                     poll_delay=None, timeout=30.0,
+
+def timestamp() -> str:
+    '''The current local time, formatted as in `%Y/%m/%d-%H:%M:%S.%f`.'''
+    t = time.time()
+    return time.strftime('%Y/%m/%d-%H:%M:%S', time.localtime(t)) + f".{int(t % 1 * 1e6):06d}"
+
+
+async def run_client(hostname: str, exec_cmd: str, *, index: int,
+                     connect_semaphore: asyncio.Semaphore, port=22,
+                     poll_delay=None, timeout=30.0, max_retry_delay=60.0,
                      name_length=None, verbose=False):
     '''An async handler to collect gpustat through a SSH channel. Contains main loop.'''
     L = name_length or 0
     if poll_delay is None:
         poll_delay = context.interval
 
+    # A remote shell loop running exec_cmd once per line read from stdin,
+    # so that all the queries go through a single SSH channel. The end marker
+    # is written to both stdout (with the exit status) and stderr; exec_cmd
+    # gets an empty stdin, as with conn.run(), not to consume the triggers.
+    loop_script = (f'while read _; do ( {exec_cmd} ) </dev/null; '
+                   f'echo "{END_MARKER} $?"; echo "{END_MARKER}" >&2; done')
+    remote_cmd = 'sh -c ' + shlex.quote(loop_script)
+
+    async def _read_stdout(proc) -> Tuple[str, int]:
+        stdout = await proc.stdout.readuntil(END_MARKER)
+        exit_status = int(await proc.stdout.readline())
+        return stdout[:-len(END_MARKER)], exit_status
+
+    async def _query(proc) -> Tuple[str, str, int]:
+        proc.stdin.write('\n')
+        (stdout, exit_status), stderr = await asyncio.gather(
+            _read_stdout(proc), proc.stderr.readuntil(END_MARKER + '\n'))
+        return stdout, stderr[:-len(END_MARKER) - 1], exit_status
+
+    fail_count = 0
+
     async def _loop_body():
-        # establish a SSH connection.
-        async with asyncssh.connect(hostname, port=port) as conn:
+        nonlocal fail_count
+        # establish a SSH connection, limiting the number of concurrent
+        # handshakes so that a burst of (re)connects won't stall the others.
+        # Unresponsive hosts must not hold a slot for long, hence the timeout.
+        async with connect_semaphore:
+            conn = await asyncio.wait_for(
+                asyncssh.connect(hostname, port=port), timeout=timeout)
+        async with conn:
             cprint(f"[{hostname:<{L}}] SSH connection established!", attrs=['bold'])
-
-            while True:
-                if False: #verbose: XXX DEBUG
-                    print(f"[{hostname:<{L}}] querying... ")
-
-                result = await asyncio.wait_for(conn.run(exec_cmd), timeout=timeout)
-
-                now = datetime.now().strftime('%Y/%m/%d-%H:%M:%S.%f')
-                if result.exit_status != 0:
-                    cprint(f"[{now} [{hostname:<{L}}] Error, exitcode={result.exit_status}", color='red')
-                    cprint(result.stderr or '', color='red')
-                    stderr_summary = (result.stderr or '').split('\n')[0]
-                    context.host_set_message(hostname, colored(f'[exitcode {result.exit_status}] {stderr_summary}', 'red'))
-                else:
-                    if verbose:
-                        cprint(f"[{now} [{hostname:<{L}}] OK from gpustat ({len(result.stdout)} bytes)", color='cyan')
-                    # update data
-                    context.host_status[hostname] = result.stdout
-                
-                render_webpage()
-
-                # wait for a while...
-                await asyncio.sleep(poll_delay)
+            fail_count = 0
+
+            async with conn.create_process(remote_cmd) as proc:
+                while True:
+                    if False: #verbose: XXX DEBUG
+                        print(f"[{hostname:<{L}}] querying... ")
+
+                    stdout, stderr, exit_status = await asyncio.wait_for(_query(proc), timeout=timeout)
+
+                    if exit_status != 0:
+                        now = timestamp()
+                        cprint(f"[{now} [{hostname:<{L}}] Error, exitcode={exit_status}", color='red')
+                        cprint(stderr, color='red')
+                        stderr_summary = stderr.split('\n')[0]
+                        context.host_set_message(index, colored(f'[exitcode {exit_status}] {stderr_summary}', 'red'))
+                    else:
+                        if verbose:
+                            now = timestamp()
+                            cprint(f"[{now} [{hostname:<{L}}] OK from gpustat ({len(stdout)} bytes)", color='cyan')
+                        # update data
+                        context.host_set_status(index, stdout)
+
+                    # wait for a while...
+                    await asyncio.sleep(poll_delay)
 
     while True:
         try:
@@ -150,21 +302,25 @@ async def run_client(hostname: str, exec_cmd: str, *, port=22,
         except (asyncio.TimeoutError) as ex:
             # timeout (retry)
             cprint(f"Timeout after {timeout} sec: {hostname}", color='red')
-            context.host_set_message(hostname, colored(f"Timeout after {timeout} sec", 'red'))
-        except (asyncssh.misc.DisconnectError, asyncssh.misc.ChannelOpenError, OSError) as ex:
+            context.host_set_message(index, colored(f"Timeout after {timeout} sec", 'red'))
+        except (asyncssh.misc.DisconnectError, asyncssh.misc.ChannelOpenError,
+                asyncio.IncompleteReadError, OSError) as ex:
             # error or disconnected (retry)
             cprint(f"Disconnected : {hostname}, {str(ex)}", color='red')
-            context.host_set_message(hostname, colored(str(ex), 'red'))
+            context.host_set_message(index, colored(str(ex), 'red'))
         except Exception as e:
             # A general exception unhandled, throw
             cprint(f"[{hostname:<{L}}] {e}", color='red')
-            context.host_set_message(hostname, colored(f"{type(e).__name__}: {e}", 'red'))
+            context.host_set_message(index, colored(f"{type(e).__name__}: {e}", 'red'))
             cprint(traceback.format_exc())
             raise
 
-        # retry upon timeout/disconnected, etc.
-        cprint(f"[{hostname:<{L}}] Disconnected, retrying in {poll_delay} sec...", color='yellow')
-        await asyncio.sleep(poll_delay)
+        # retry upon timeout/disconnected, etc. with exponential backoff;
+        # the jitter avoids all the hosts reconnecting at the same time.
+        delay = min(max_retry_delay, poll_delay * 2 ** fail_count) + random.uniform(0, poll_delay)
+        fail_count = min(fail_count + 1, 16)  # avoid overflowing 2 ** fail_count
+        cprint(f"[{hostname:<{L}}] Disconnected, retrying in {delay:.1f} sec...", color='yellow')
+        await asyncio.sleep(delay)
 
 
 def main():
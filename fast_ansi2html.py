@@ -0,0 +1,97 @@
+"""
+A minimal ANSI (SGR) to HTML converter for gpustat output.
+
+Emits the same css classes as ansi2html (e.g. `ansi1`, `ansi32`, `ansi38-214`),
+so the stylesheet from `Ansi2HTMLConverter.produce_headers()` still applies.
+Only the subset of SGR sequences gpustat emits is rendered; reverse video
+(SGR 7/27) and truecolor (38;2 / 48;2) are not supported, and other escape
+sequences are dropped.
+"""
+
+import re
+from typing import Dict, Optional, Tuple
+
+
+# CSI sequences (`ESC [ ... <cmd>`) and charset designators (`ESC ( B`),
+# the latter being emitted by blessed as part of `sgr0` on xterm.
+ANSI_ESCAPE_RE = re.compile('\x1b(?:\\[([0-9;:]*)([A-Za-z])|\\([0-9A-Za-z])')
+
+# Attribute slots of the SGR state, in the order ansi2html lists their classes.
+_SLOTS = ('intensity', 'style', 'blink', 'underline', 'crossedout',
+          'visibility', 'foreground', 'background')
+
+# SGR code -> (slot, css class); a css class of None resets the slot.
+SGR_CODES: Dict[int, Tuple[str, Optional[str]]] = {
+    1: ('intensity', 'ansi1'), 2: ('intensity', 'ansi2'), 22: ('intensity', None),
+    3: ('style', 'ansi3'), 23: ('style', None),
+    5: ('blink', 'ansi5'), 6: ('blink', 'ansi6'), 25: ('blink', None),
+    4: ('underline', 'ansi4'), 24: ('underline', None),
+    9: ('crossedout', 'ansi9'), 29: ('crossedout', None),
+    8: ('visibility', 'ansi8'), 28: ('visibility', None),
+    39: ('foreground', None), 49: ('background', None),
+}
+SGR_CODES.update({c: ('foreground', 'ansi%d' % c) for c in (*range(30, 38), *range(90, 98))})
+SGR_CODES.update({c: ('background', 'ansi%d' % c) for c in (*range(40, 48), *range(100, 108))})
+
+_HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'))
+
+
+def _apply_sgr(state: Dict[str, str], params: str):
+    '''Update the attribute state in-place with the parameters of one SGR sequence.'''
+    codes = [int(x) if x else 0 for x in params.replace(':', ';').split(';')]
+    i, n = 0, len(codes)
+    while i < n:
+        code = codes[i]
+        i += 1
+        if code == 0:
+            state.clear()
+        elif code in (38, 48):
+            slot = 'foreground' if code == 38 else 'background'
+            mode = codes[i] if i < n else -1
+            if mode == 5 and i + 1 < n:     # 256 colors
+                state[slot] = 'ansi%d-%d' % (code, codes[i + 1])
+                i += 2
+            elif mode == 2:                 # truecolor: not supported, skip
+                i += 4
+            else:
+                i = n
+        elif code in SGR_CODES:
+            slot, css_class = SGR_CODES[code]
+            if css_class is None:
+                state.pop(slot, None)
+            else:
+                state[slot] = css_class
+
+
+def convert(ansi: str) -> str:
+    '''Convert a string with ANSI escape codes into a html fragment, like
+    `Ansi2HTMLConverter.convert(ansi, full=False)` does for the SGR subset
+    used by gpustat. Reverse video and truecolor colors are ignored.'''
+    for pattern, special in _HTML_ESCAPES:
+        ansi = ansi.replace(pattern, special)
+
+    out = []
+    state: Dict[str, str] = {}
+    inside_span = False
+    last_end = 0
+    for match in ANSI_ESCAPE_RE.finditer(ansi):
+        out.append(ansi[last_end:match.start()])
+        last_end = match.end()
+
+        params, command = match.groups()
+        if command != 'm':
+            continue
+        _apply_sgr(state, params)
+
+        if inside_span:
+            out.append('</span>')
+            inside_span = False
+        if state:
+            out.append('<span class="%s">' % ' '.join(
+                state[slot] for slot in _SLOTS if slot in state))
+            inside_span = True
+
+    out.append(ansi[last_end:])
+    if inside_span:
+        out.append('</span>')
+    return ''.join(out)